@@ -1,49 +1,23 @@
 import asyncio
+import hashlib
+import json
 import os
+import time
+from functools import lru_cache
 from dotenv import load_dotenv
 from agno.agent import Agent, RunResponse
-from agno.models.openai import OpenAIChat
 from agno.tools.mcp import MCPTools
 from typing import Optional, List
 from mcp import ClientSession, StdioServerParameters
 from textwrap import dedent
 from mcp.client.stdio import stdio_client
 from agno.utils.log import logger
+from openai_model import make_openai
+from specialties import lookup_specialties
+from symptom_agent import SymptomAnalyzer
 import signal
 import sys
 
-# Instructions for the Symptom Analysis Agent
-SYMPTOM_ANALYZER_INSTRUCTIONS = dedent(
-    """\
-    You are a medical symptom analysis agent. Your job is to analyze symptoms and conditions 
-    mentioned by users and identify which medical specialties would be most appropriate.
-
-    When given symptoms or conditions, you should:
-    1. Analyze the symptoms carefully
-    2. Identify the most relevant medical specialties that typically handle these symptoms
-    3. Provide a list of specialty names that are commonly used in medical databases
-
-    For example:
-    - "chest pain, shortness of breath, palpitations" → ["Cardiologist", "Cardiology"]
-    - "headache, dizziness, memory problems" → ["Neurologist", "Neurology"] 
-    - "stomach pain, nausea, diarrhea" → ["Gastroenterologist", "Gastroenterology"]
-    - "joint pain, back pain, fracture" → ["Orthopedic Surgeon", "Orthopedics", "Orthopedist"]
-    - "skin rash, acne, hair loss" → ["Dermatologist", "Dermatology"]
-
-    IMPORTANT RULES:
-    - Return ONLY a comma-separated list of specialty names
-    - Use standard medical specialty names as they would appear in a hospital database
-    - Include common variations (e.g., "Cardiologist, Cardiology, Heart Specialist")
-    - Do not provide explanations, just the specialty list
-    - If unsure, include the most likely specialties
-
-    Example responses:
-    "Cardiologist, Cardiology, Heart Specialist"
-    "Neurologist, Neurology, Brain Specialist"
-    "Gastroenterologist, Gastroenterology, Digestive Specialist"
-    """
-)
-
 # Instructions for the Database Query Agent
 DATABASE_QUERY_INSTRUCTIONS = dedent(
     """\
@@ -56,6 +30,11 @@ DATABASE_QUERY_INSTRUCTIONS = dedent(
     4. Use flexible matching (LIKE operator) to find partial matches
     5. Present results in a clear, user-friendly format
 
+    When the message describes symptoms instead of listing specialties:
+    - First infer the medical specialties that typically handle those symptoms
+      (e.g., chest pain → Cardiologist, Cardiology; headache → Neurologist, Neurology)
+    - Then search for consultants matching ANY of the inferred specialties
+
     When searching for specialties:
     - Use OR conditions to match any of the provided specialties
     - Use LIKE operator with % wildcards for flexible matching
@@ -63,9 +42,9 @@ DATABASE_QUERY_INSTRUCTIONS = dedent(
 
     Example SQL pattern:
     ```sql
-    SELECT * FROM consultants 
-    WHERE specialty LIKE '%Cardiologist%' 
-       OR specialty LIKE '%Cardiology%' 
+    SELECT * FROM consultants
+    WHERE specialty LIKE '%Cardiologist%'
+       OR specialty LIKE '%Cardiology%'
        OR specialty LIKE '%Heart%'
     ```
 
@@ -89,66 +68,24 @@ MODEL_API_KEY = os.getenv('MODEL_API_KEY')
 if not MODEL_ID or not MODEL_API_KEY:
     raise ValueError('MODEL_ID and MODEL_API_KEY must be set')
 
+# Model shared by every database agent; agents themselves are built per query,
+# since they keep run state and memory on the instance
+_database_model = make_openai(MODEL_ID, MODEL_API_KEY)
 
-class DatabaseAgent:
-    """A class to manage database agent lifecycle and cleanup"""
-
-    def __init__(self):
-        self.session = None
-        self.agent = None
-
-    async def cleanup(self):
-        """Properly cleanup resources"""
-        try:
-            if self.session and hasattr(self.session, 'close'):
-                await self.session.close()
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.warning(f"Cleanup warning: {e}")
+async def create_mcp_tools(session: ClientSession) -> MCPTools:
+    """Create the MCP toolkit for a session, listing the server's tools once"""
+    mcp_tool = MCPTools(session=session)
+    await mcp_tool.initialize()
+    return mcp_tool
 
 
-def create_symptom_analyzer() -> Agent:
-    """Create the symptom analysis agent (no database connection needed)"""
-    try:
-        # Try different parameter names for OpenAIChat
-        try:
-            openai_model = OpenAIChat(model=MODEL_ID, api_key=MODEL_API_KEY)
-        except TypeError:
-            try:
-                openai_model = OpenAIChat(model_name=MODEL_ID, api_key=MODEL_API_KEY)
-            except TypeError:
-                openai_model = OpenAIChat(MODEL_ID, api_key=MODEL_API_KEY)
-
-        return Agent(
-            model=openai_model,
-            instructions=SYMPTOM_ANALYZER_INSTRUCTIONS,
-            markdown=False,
-            show_tool_calls=False,
-        )
-    except Exception as e:
-        logger.error(f"Error creating symptom analyzer: {e}")
-        raise
-
-
-async def create_database_agent(session: ClientSession) -> Agent:
+def create_database_agent(mcp_tool: MCPTools) -> Agent:
     """Create the database query agent with MCP tools"""
     try:
-        mcp_tool = MCPTools(session=session)
-        await mcp_tool.initialize()
-
-        # Try different parameter names for OpenAIChat
-        try:
-            openai_model = OpenAIChat(model=MODEL_ID, api_key=MODEL_API_KEY)
-        except TypeError:
-            try:
-                openai_model = OpenAIChat(model_name=MODEL_ID, api_key=MODEL_API_KEY)
-            except TypeError:
-                openai_model = OpenAIChat(MODEL_ID, api_key=MODEL_API_KEY)
-
         return Agent(
-            model=openai_model,
+            model=_database_model,
             tools=[mcp_tool],
-            instructions=DATABASE_QUERY_INSTRUCTIONS,
+            system_message=DATABASE_QUERY_INSTRUCTIONS,
             markdown=False,
             show_tool_calls=True,
         )
@@ -157,39 +94,9 @@ async def create_database_agent(session: ClientSession) -> Agent:
         raise
 
 
-async def analyze_symptoms_and_find_consultants(user_query: str) -> RunResponse:
-    """
-    Two-step process:
-    1. Analyze symptoms to identify relevant specialties
-    2. Query database for consultants in those specialties
-    """
-    required_variables = ["DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME"]
-    missing_variables = [var for var in required_variables if not os.getenv(var)]
-    if missing_variables:
-        raise ValueError(f'Missing required environment variables: {", ".join(missing_variables)}')
-
-    # Step 1: Analyze symptoms to get specialties
-    logger.info("Step 1: Analyzing symptoms to identify specialties...")
-    symptom_analyzer = create_symptom_analyzer()
-
-    # Create a specific prompt for the symptom analyzer
-    symptom_analysis_prompt = f"""
-    Analyze these symptoms/conditions and return the relevant medical specialties:
-
-    User query: "{user_query}"
-
-    Return only the specialty names, comma-separated.
-    """
-
-    specialty_response = await symptom_analyzer.arun(symptom_analysis_prompt)
-    specialties = specialty_response.content.strip()
-
-    logger.info(f"Identified specialties: {specialties}")
-
-    # Step 2: Query database using identified specialties
-    logger.info("Step 2: Querying database for consultants...")
-
-    server_parameters = StdioServerParameters(
+def build_server_parameters() -> StdioServerParameters:
+    """Build the stdio parameters used to launch the MCP SQL server"""
+    return StdioServerParameters(
         command='uvx',
         args=[
             'mcp-sql-server',
@@ -200,34 +107,205 @@ async def analyze_symptoms_and_find_consultants(user_query: str) -> RunResponse:
         ],
     )
 
-    db_agent = DatabaseAgent()
 
+# How long a caller waits for the MCP server to start (initialize and list its tools)
+MCP_START_TIMEOUT = 15.0
+# How long the MCP server gets to answer the health probe after a failed query
+MCP_PING_TIMEOUT = 0.5
+# Upper bound on waiting for the MCP server to shut down
+MCP_CLOSE_TIMEOUT = 2.0
+
+
+class MCPSessionManager:
+    """Keep a single MCP stdio session and its toolkit alive across queries"""
+
+    def __init__(self):
+        self.session = None
+        self.tools = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._ready = None
+        self._shutdown = None
+
+    async def _serve(self, ready: asyncio.Future):
+        """Hold the MCP server process and session open until close() is called"""
+        try:
+            async with stdio_client(build_server_parameters()) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self.tools = await create_mcp_tools(session)
+                    if not ready.done():
+                        ready.set_result(None)
+                    await self._shutdown.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(f"MCP session ended unexpectedly: {e}")
+        finally:
+            # Cancelled before it was ready: fail the callers waiting on startup instead of leaving them hanging
+            if not ready.done():
+                ready.set_exception(RuntimeError("MCP session closed before it was ready"))
+            self.session = None
+            self.tools = None
+
+    async def start(self):
+        """Start the MCP session if it is not already running"""
+        async with self._lock:
+            if self._task is None or self._task.done():
+                self._shutdown = asyncio.Event()
+                self._ready = asyncio.get_running_loop().create_future()
+                self._task = asyncio.create_task(self._serve(self._ready))
+            ready = self._ready
+            task = self._task
+
+        # Startup already lists the server's tools, so a server that answers in time is healthy.
+        # Shielded so a caller timing out doesn't cancel the startup other callers share.
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), MCP_START_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            # A hung startup never reaches the shutdown wait, so cancel it rather than leave it for close()
+            task.cancel()
+            raise RuntimeError(f"MCP server did not start within {MCP_START_TIMEOUT}s") from e
+
+    async def query(self, prompt: str) -> RunResponse:
+        """Run a prompt through a new database agent on the shared session"""
+        await self.start()
+        session = self.session
+        try:
+            return await create_database_agent(self.tools).arun(prompt)
+        except Exception:
+            # Re-check the server; if it stopped answering, drop the session so the next query starts a new one
+            try:
+                await asyncio.wait_for(session.list_tools(), MCP_PING_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"MCP server did not respond to health check, restarting it: {e!r}")
+                await self.close()
+            raise
+
+    async def close(self):
+        """Shut down the MCP session and server process"""
+        if self._task is not None and not self._task.done():
+            self._shutdown.set()
+            try:
+                await asyncio.wait_for(self._task, MCP_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # wait_for cancelled the owner task, which tears down the stdio client
+                logger.warning(f"MCP session did not close within {MCP_CLOSE_TIMEOUT}s, cancelled it")
+        self._task = None
+
+
+mcp_manager = MCPSessionManager()
+
+
+# On-disk cache of symptom analysis results (normalized query -> specialties)
+SYMPTOM_CACHE_PATH = os.getenv(
+    'SYMPTOM_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.symptom_cache.json'),
+)
+SYMPTOM_CACHE_TTL = 86400
+
+
+@lru_cache(maxsize=1)
+def _load_symptom_cache() -> dict:
+    """Load the symptom cache from disk on first use, starting empty if it is missing or unreadable"""
+    try:
+        with open(SYMPTOM_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _symptom_cache_key(user_query: str) -> str:
+    """Hash the lowercased, whitespace-collapsed query"""
+    normalized = " ".join(user_query.lower().split())
+    return hashlib.blake2b(normalized.encode('utf-8')).hexdigest()
+
+
+def get_cached_specialties(user_query: str) -> Optional[str]:
+    """Return cached specialties for a query, or None on a miss or expired entry"""
+    entry = _load_symptom_cache().get(_symptom_cache_key(user_query))
+    if entry and time.time() - entry['ts'] < SYMPTOM_CACHE_TTL:
+        return entry['specialties']
+    return None
+
+
+def cache_specialties(user_query: str, specialties: str) -> None:
+    """Store specialties for a query and persist the cache to disk"""
+    cache = _load_symptom_cache()
+    cache[_symptom_cache_key(user_query)] = {'specialties': specialties, 'ts': time.time()}
     try:
-        async with stdio_client(server_parameters) as (read, write):
-            async with ClientSession(read, write) as session:
-                db_agent.session = session
-                await session.initialize()
+        tmp_path = f"{SYMPTOM_CACHE_PATH}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, SYMPTOM_CACHE_PATH)
+    except OSError as e:
+        logger.warning(f"Could not persist symptom cache: {e}")
 
-                database_agent = await create_database_agent(session)
 
-                # Create database query prompt
-                db_query_prompt = f"""
-                Find consultants who specialize in treating these conditions: {user_query}
+@lru_cache(maxsize=1)
+def create_symptom_analyzer() -> SymptomAnalyzer:
+    """Create the standalone symptom analyzer once; it builds a fresh agent per analysis"""
+    return SymptomAnalyzer()
 
-                Based on the symptom analysis, search for consultants with these specialties: {specialties}
 
-                Use flexible matching to find consultants whose specialties match any of: {specialties}
-                """
+async def identify_specialties(user_query: str) -> str:
+    """
+    Classify a symptom query into specialties without querying the database.
+    Uses the keyword table or cache when possible, otherwise the symptom analyzer.
+    Consultant searches don't need this: the database agent infers specialties itself.
+    """
+    specialties = lookup_specialties(user_query)
+    if specialties is not None:
+        logger.info("Matched symptoms against local keyword table")
+        return specialties
+
+    specialties = get_cached_specialties(user_query)
+    if specialties is not None:
+        logger.info("Using cached symptom analysis")
+        return specialties
+
+    specialties = await create_symptom_analyzer().analyze_symptoms(user_query)
+    if specialties:
+        cache_specialties(user_query, specialties)
+    return specialties
+
+
+async def analyze_symptoms_and_find_consultants(user_query: str) -> RunResponse:
+    """
+    Find consultants for a symptom query in a single database agent turn.
+    Common symptoms are mapped to specialties locally; otherwise the database
+    agent infers the specialties itself before querying.
+    """
+    required_variables = ["DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME"]
+    missing_variables = [var for var in required_variables if not os.getenv(var)]
+    if missing_variables:
+        raise ValueError(f'Missing required environment variables: {", ".join(missing_variables)}')
+
+    try:
+        await mcp_manager.start()
+    except Exception as e:
+        logger.error(f"MCP session unavailable: {str(e)}")
+        raise RuntimeError(f"Error connecting to database or running query: {e}") from e
 
-                response = await database_agent.arun(db_query_prompt)
-                return response
+    specialties = lookup_specialties(user_query)
 
+    if specialties is not None:
+        logger.info(f"Identified specialties: {specialties}")
+        db_query_prompt = f'Find consultants matching any of: {specialties}. Original query: "{user_query}".'
+    else:
+        db_query_prompt = (
+            f'Find consultants for: "{user_query}". '
+            'Infer the relevant specialties first, then match any of them.'
+        )
+
+    logger.info("Querying database for consultants...")
+    try:
+        return await mcp_manager.query(db_query_prompt)
     except Exception as e:
         logger.error(f"Error in database query: {str(e)}")
         raise RuntimeError(f"Error connecting to database or running query: {e}") from e
-    finally:
-        await db_agent.cleanup()
-        await asyncio.sleep(0.2)
 
 
 def signal_handler(signum, frame):
@@ -267,6 +345,8 @@ async def main():
         import traceback
         logger.error(f"Full traceback: {traceback.format_exc()}")
         return 1
+    finally:
+        await mcp_manager.close()
 
     return 0
 
@@ -1,12 +1,24 @@
 import streamlit as st
 import asyncio
+import atexit
 import logging
 import traceback
 import os
 import sys
 import re
+import html
+import queue
+import threading
+import uuid
+from typing import List, Tuple
 from dotenv import load_dotenv
-from database_agent import process_chat_message  # Import from agent.py
+from streamlit.errors import StreamlitAPIException
+try:
+    from database_agent import check_mcp_health, close_mcp_session, get_memory, load_history, process_chat_message_stream, warmup_openai_connection  # Import from agent.py
+except RuntimeError as e:
+    # Missing DB settings fail the import; show them on the page rather than crashing the app
+    st.error(f"Configuration error: {e}")
+    st.stop()
 
 # Fix for Windows asyncio subprocess issue
 if sys.platform == 'win32':
@@ -17,6 +29,21 @@ if sys.platform == 'win32':
 load_dotenv()
 logger = logging.getLogger(__name__)
 
+# Messages the shared queue worker processes at once
+MAX_CONCURRENT_MESSAGES = 8
+
+# Keep a conversation across page reloads by putting its id in the URL. Off by default:
+# anyone with the link can read the stored chat, so this is only for trusted deployments
+PERSIST_CHAT_HISTORY = os.getenv('PERSIST_CHAT_HISTORY', '').lower() in ('1', 'true', 'yes')
+
+# Pattern for the consultant list emitted by the database agent
+_CONSULTANT_RE = re.compile(r'Found consultants:\s*\[(.*?)\]', re.DOTALL)
+# One "Dr. Name - Specialty" entry; entries are separated by ", Dr."
+_ENTRY_RE = re.compile(
+    r'(?:^\s*|,\s*Dr\.\s*)(?:Dr\.\s*)?((?:(?!,\s*Dr\.).)+?)\s+-\s+(.+?)(?=,\s*Dr\.|\s*$)',
+    re.DOTALL
+)
+
 # Set up logging with detailed format
 logging.basicConfig(
     level=logging.INFO,
@@ -24,11 +51,8 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 
-# Log environment variables and system info for debugging
-logger.info(
-    f"Environment variables: DB_HOST={os.getenv('DB_HOST')}, DB_USER={os.getenv('DB_USER')}, DB_NAME={os.getenv('DB_NAME')}")
-logger.info(f"Current working directory: {os.getcwd()}")
-logger.info(f"PATH: {os.getenv('PATH')}")
+# Log system info for debugging (DB settings and PATH are left out of the logs)
+logger.debug("Current working directory: %s", os.getcwd())
 logger.info(f"Platform: {sys.platform}")
 logger.info(f"Event loop policy: {asyncio.get_event_loop_policy()}")
 
@@ -39,157 +63,316 @@ st.set_page_config(
     layout="wide"
 )
 
+# Styles for the consultant cards and callouts, injected once per page
+APP_STYLES = """
+<style>
+.consultant-grid { display: grid; grid-template-columns: repeat(2, 1fr); column-gap: 16px; }
+.consultant-grid.single { grid-template-columns: 1fr; }
+.consultant-card {
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    padding: 20px;
+    border-radius: 15px;
+    margin: 10px 0;
+    box-shadow: 0 4px 15px rgba(0,0,0,0.1);
+    color: white;
+    border-left: 5px solid #4CAF50;
+}
+.consultant-card h4 { margin: 0 0 10px 0; font-size: 1.2em; color: white; }
+.consultant-card p { margin: 0; font-size: 1em; opacity: 0.9; }
+.callout { padding: 12px 16px; border-radius: 8px; margin: 10px 0; }
+.callout-info { background: rgba(28, 131, 225, 0.1); border-left: 4px solid #1c83e1; }
+.callout-warning { background: rgba(255, 189, 69, 0.15); border-left: 4px solid #ffbd45; }
+</style>
+"""
+
 # Initialize session state
+if 'user_id' not in st.session_state:
+    # Key for the chat memory; without PERSIST_CHAT_HISTORY it lives only in this browser session
+    user_id = uuid.uuid4().hex
+    if PERSIST_CHAT_HISTORY:
+        url_user_id = st.query_params.get("uid", "")
+        if re.fullmatch(r'[0-9a-f]{32}', url_user_id):
+            user_id = url_user_id
+        else:
+            st.query_params["uid"] = user_id
+    elif "uid" in st.query_params:
+        # Don't leave an old conversation key in the address bar
+        del st.query_params["uid"]
+    st.session_state.user_id = user_id
 if 'conversation_history' not in st.session_state:
-    st.session_state.conversation_history = []
+    st.session_state.conversation_history = [
+        {"user": user, "assistant": assistant, "rendered": None}
+        for user, assistant in load_history(st.session_state.user_id)
+    ]
 if 'processing' not in st.session_state:
     st.session_state.processing = False
 if 'input_key' not in st.session_state:
     st.session_state.input_key = 0
 
 
-def format_assistant_response(response_text):
-    """Format assistant response with enhanced styling for consultant lists"""
+def _info(text):
+    """Blue informational callout"""
+    return f'<div class="callout callout-info">{text}</div>'
+
 
+def _warning(text):
+    """Amber warning callout"""
+    return f'<div class="callout callout-warning">{text}</div>'
+
+
+def format_assistant_response(response_text) -> Tuple[str, bool]:
+    """
+    Format assistant response with enhanced styling for consultant lists.
+    Returns (markdown, is_html); only the card and callout layouts need unsafe_allow_html.
+    """
     # Check if response contains consultant information
     if "Found consultants:" in response_text:
         # Extract the consultant list
-        consultant_match = re.search(r'Found consultants:\s*\[(.*?)\]', response_text)
-        if consultant_match:
-            consultant_data = consultant_match.group(1)
-
-            # Parse individual consultants
-            consultants = []
-            consultant_entries = consultant_data.split(', Dr. ')
-
-            for i, entry in enumerate(consultant_entries):
-                if i == 0:
-                    # First entry already has "Dr."
-                    if entry.startswith('Dr. '):
-                        entry = entry[4:]  # Remove "Dr. " prefix
-                else:
-                    # Add back "Dr." for subsequent entries
-                    pass
-
-                # Split name and specialty
-                if ' - ' in entry:
-                    name, specialty = entry.split(' - ', 1)
-                    consultants.append({
-                        'name': f"Dr. {name}" if not name.startswith('Dr.') else name,
-                        'specialty': specialty
-                    })
-
-            # Display formatted consultant cards
-            if consultants:
-                st.markdown("### 🏥 **Found Medical Consultants**")
-
-                # Create columns for better layout
-                cols = st.columns(min(len(consultants), 2))
-
-                for i, consultant in enumerate(consultants):
-                    with cols[i % 2]:
-                        st.markdown(f"""
-                        <div style="
-                            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                            padding: 20px;
-                            border-radius: 15px;
-                            margin: 10px 0;
-                            box-shadow: 0 4px 15px rgba(0,0,0,0.1);
-                            color: white;
-                            border-left: 5px solid #4CAF50;
-                        ">
-                            <h4 style="margin: 0 0 10px 0; font-size: 1.2em;">
-                                👨‍⚕️ {consultant['name']}
-                            </h4>
-                            <p style="margin: 0; font-size: 1em; opacity: 0.9;">
-                                🏥 <strong>Specialty:</strong> {consultant['specialty']}
-                            </p>
-                        </div>
-                        """, unsafe_allow_html=True)
-
-                # Add summary
-                st.info(f"📋 **Total consultants found:** {len(consultants)}")
-
-                # Add helpful note
-                st.markdown("""
-                ---
-                💡 **Next Steps:**
-                - Contact any of the specialists above for consultation
-                - Prepare a list of your symptoms before the appointment
-                - Bring any relevant medical records or test results
-                """)
-            else:
-                st.warning("No consultants found in the response.")
-        else:
-            st.write(response_text)
+        consultant_match = _CONSULTANT_RE.search(response_text)
+        if not consultant_match:
+            return response_text, False
+
+        consultant_data = consultant_match.group(1)
+
+        # Parse individual consultants
+        consultants = [
+            {'name': html.escape(f"Dr. {name}"), 'specialty': html.escape(specialty)}
+            for name, specialty in _ENTRY_RE.findall(consultant_data)
+        ]
+
+        if not consultants:
+            return _warning("No consultants found in the response."), True
+
+        # Consultant cards in a grid of up to two columns
+        cards = "".join(
+            f'<div class="consultant-card"><h4>👨‍⚕️ {consultant["name"]}</h4>'
+            f'<p>🏥 <strong>Specialty:</strong> {consultant["specialty"]}</p></div>'
+            for consultant in consultants
+        )
+        grid_class = "consultant-grid" if len(consultants) > 1 else "consultant-grid single"
+
+        return "\n\n".join([
+            "### 🏥 **Found Medical Consultants**",
+            f'<div class="{grid_class}">{cards}</div>',
+            _info(f"📋 <strong>Total consultants found:</strong> {len(consultants)}"),
+            "---",
+            "💡 **Next Steps:**\n"
+            "- Contact any of the specialists above for consultation\n"
+            "- Prepare a list of your symptoms before the appointment\n"
+            "- Bring any relevant medical records or test results",
+        ]), True
 
     elif "No consultants found" in response_text:
-        st.warning("🔍 " + response_text)
-        st.markdown("""
-        **Suggestions:**
-        - Try describing your symptoms in different words
-        - Be more specific about your condition
-        - Ask about general practitioners or internal medicine doctors
-        """)
+        return "\n\n".join([
+            _warning("🔍 " + html.escape(response_text)),
+            "**Suggestions:**\n"
+            "- Try describing your symptoms in different words\n"
+            "- Be more specific about your condition\n"
+            "- Ask about general practitioners or internal medicine doctors",
+        ]), True
 
     elif "?" in response_text:
         # This is a clarification question
-        st.info("❓ " + response_text)
-        st.markdown("*Please provide more details about your symptoms to get better recommendations.*")
+        return "\n\n".join([
+            _info("❓ " + html.escape(response_text)),
+            "*Please provide more details about your symptoms to get better recommendations.*",
+        ]), True
+
+    # Regular response, rendered as plain markdown without raw HTML
+    return response_text, False
+
 
-    else:
-        # Regular response
-        st.write(response_text)
+def show_assistant_response(target, rendered: Tuple[str, bool]):
+    """Render a formatted response, allowing HTML only for the app's own layouts"""
+    text, is_html = rendered
+    target.markdown(text, unsafe_allow_html=is_html)
 
 
-def run_async_task(coro):
+@st.cache_resource
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """
+    Start a single event loop on a daemon thread, shared across Streamlit reruns.
+    Keeping the loop alive preserves the HTTP connection pools held by the agents.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="async-loop", daemon=True).start()
+    # Stop the shared MCP server process when Streamlit exits
+    atexit.register(lambda: asyncio.run_coroutine_threadsafe(close_mcp_session(), loop).result(timeout=5))
+    return loop
+
+
+@st.cache_resource
+def start_openai_warmup():
+    """Warm the OpenAI connection pool on the background loop, once per process"""
+    return asyncio.run_coroutine_threadsafe(warmup_openai_connection(), get_background_loop())
+
+
+def run_async_task(coro, timeout: float = 60.0):
     """
     Helper function to run async tasks in Streamlit
-    Handles event loop creation properly for Windows
+    Schedules the coroutine on the persistent background event loop and waits for it;
+    on timeout the coroutine is cancelled so it doesn't linger on the loop
     """
+    future = asyncio.run_coroutine_threadsafe(coro, get_background_loop())
     try:
-        # Try to get the current event loop
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # If loop is already running (common in Streamlit),
-            # we need to use asyncio.run in a thread
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, coro)
-                return future.result()
-        else:
-            # If no loop is running, we can use the existing loop
-            return loop.run_until_complete(coro)
-    except RuntimeError:
-        # If no event loop exists, create a new one
-        return asyncio.run(coro)
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        raise
+
+
+async def process_user_message_async(user_message: str, user_id: str, sink: queue.Queue):
+    """
+    Async wrapper for processing user messages.
+    Puts response chunks ({"response", "status"} dicts) on the thread-safe sink as they arrive, then None when done.
+    """
+    try:
+        if not user_message.strip():
+            sink.put({"response": "Please enter a valid message.", "status": "clarification"})
+            return
+
+        try:
+            async with asyncio.timeout(30.0):
+                async for chunk in process_chat_message_stream(user_message, user_id=user_id):
+                    sink.put(chunk)
+        except TimeoutError:
+            sink.put({
+                "response": "Error: Database query timed out after 30 seconds. Please check if the database server is running.",
+                "status": "error",
+            })
+            # A hung MCP server would time out every message; restart it if it no longer answers
+            await check_mcp_health()
+        except Exception as e:
+            sink.put({
+                "response": f"Error processing message: {str(e)}\nPlease check if 'uvx mcp-sql-server' is accessible and the database is running.",
+                "status": "error",
+            })
+    finally:
+        sink.put(None)
+
+
+async def server_loop(model_queue: asyncio.Queue):
+    """
+    Single worker behind the message queue.
+    Starts each message as its own task as soon as it is dequeued,
+    with at most MAX_CONCURRENT_MESSAGES in flight.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_MESSAGES)
+    tasks = set()  # Strong references, so running tasks aren't garbage collected
+
+    def finish(task: asyncio.Task):
+        tasks.discard(task)
+        semaphore.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error in message worker: {task.exception()}")
+
+    while True:
+        item = await model_queue.get()
+        await semaphore.acquire()
+        task = asyncio.create_task(process_user_message_async(*item))
+        tasks.add(task)
+        task.add_done_callback(finish)
+
 
+@st.cache_resource
+def get_model_queue() -> asyncio.Queue:
+    """Create the shared message queue and start its worker on the background loop"""
+    model_queue = asyncio.Queue()
+    asyncio.run_coroutine_threadsafe(server_loop(model_queue), get_background_loop())
+    return model_queue
 
-async def process_user_message_async(user_message: str, conversation_history):
-    """Async wrapper for processing user messages"""
-    if not user_message.strip():
-        return {"response": "Please enter a valid message.", "status": "error"}
 
+def stream_response(user_message: str, user_id: str, parts: List[str]):
+    """
+    Queue a message for the batch worker and yield its response text as it arrives.
+    parts collects the final response; an error replaces any partial text streamed before it.
+    """
+    sink = queue.Queue()
+    run_async_task(get_model_queue().put((user_message, user_id, sink)))
+    while (chunk := sink.get()) is not None:
+        if chunk["status"] == "error":
+            parts.clear()
+        parts.append(chunk["response"])
+        yield chunk["response"]
+
+
+def rerun_chat():
+    """Rerun just the chat fragment, or the whole app when called during a full run"""
     try:
-        result = await asyncio.wait_for(
-            process_chat_message(user_message, conversation_history),
-            timeout=30.0
-        )
-        return result
-    except asyncio.TimeoutError:
-        return {
-            "response": "Error: Database query timed out after 30 seconds. Please check if the database server is running.",
-            "status": "error"
-        }
-    except Exception as e:
-        return {
-            "response": f"Error processing message: {str(e)}\nPlease check if 'uvx mcp-sql-server' is accessible and the database is running.",
-            "status": "error"
-        }
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+@st.fragment
+def chat_interface():
+    """
+    Chat history, the in-flight response and the Clear button.
+    Runs as a fragment so clearing the chat doesn't rerun the rest of the page.
+    The input box stays in main(), since a chat input inside a fragment isn't pinned to the bottom.
+    """
+    # Chat container
+    chat_container = st.container()
+    with chat_container:
+        for msg in st.session_state.conversation_history:
+            with st.chat_message("user"):
+                st.write(msg["user"])
+            # The in-flight message's response is streamed in below
+            if msg["assistant"] is not None:
+                # Format each message once; later reruns reuse the cached result
+                if msg.get("rendered") is None:
+                    msg["rendered"] = format_assistant_response(msg["assistant"])
+                with st.chat_message("assistant"):
+                    show_assistant_response(st, msg["rendered"])
+
+    # Check if there's a message being processed
+    if (st.session_state.processing and
+            st.session_state.conversation_history and
+            st.session_state.conversation_history[-1]["assistant"] is None):
+
+        last_message = st.session_state.conversation_history[-1]
+        with chat_container:
+            with st.chat_message("assistant"):
+                placeholder = st.empty()
+        placeholder.info("🔄 Processing your message...")
+
+        try:
+            parts = []
+            with placeholder.container():
+                st.write_stream(stream_response(
+                    last_message["user"],
+                    st.session_state.user_id,
+                    parts
+                ))
+            response = "".join(parts).strip()
+
+        except Exception as e:
+            response = f"Error processing message: {str(e)}"
+            logger.error(f"Error in main processing: {e}\n{traceback.format_exc()}")
+
+        # Update the message with the response
+        last_message["assistant"] = response
+        last_message["rendered"] = format_assistant_response(response)
+        show_assistant_response(placeholder, last_message["rendered"])
+        st.session_state.processing = False
+
+        # Re-enable the input box, which lives outside the fragment
+        st.rerun()
+
+    # Clear conversation button
+    if st.session_state.conversation_history:
+        if st.button("Clear Conversation"):
+            st.session_state.conversation_history = []
+            get_memory().clear(st.session_state.user_id)
+            st.session_state.input_key += 1
+            rerun_chat()
 
 
 def main():
     """Main Streamlit chat application"""
+    start_openai_warmup()
+    st.markdown(APP_STYLES, unsafe_allow_html=True)
+
     st.title("🏥 Medical Consultant Chat")
     st.markdown("""
     <div style="
@@ -222,20 +405,9 @@ def main():
         st.write(f"**Python version:** {sys.version}")
         st.write(f"**Database:** {os.getenv('DB_HOST', 'Not configured')}/{os.getenv('DB_NAME', 'Not configured')}")
 
-    # Chat container
-    chat_container = st.container()
-    with chat_container:
-        for msg in st.session_state.conversation_history:
-            with st.chat_message("user"):
-                st.write(msg["user"])
-            with st.chat_message("assistant"):
-                if msg["assistant"] is not None:
-                    format_assistant_response(msg["assistant"])
-                else:
-                    # Show processing indicator for messages without responses yet
-                    st.info("🔄 Processing your message...")
+    chat_interface()
 
-    # Input box
+    # Input box, at the top level so Streamlit pins it to the bottom of the page
     user_input = st.chat_input(
         "Describe your symptoms or ask a question:",
         key=f"chat_input_{st.session_state.input_key}",
@@ -244,47 +416,12 @@ def main():
 
     # Process input
     if user_input and not st.session_state.processing:
-        # Immediately add user message to conversation history
-        st.session_state.conversation_history.append({"user": user_input, "assistant": None})
+        # Immediately add user message to conversation history; the chat fragment picks it up on the rerun
+        st.session_state.conversation_history.append({"user": user_input, "assistant": None, "rendered": None})
         st.session_state.input_key += 1
         st.session_state.processing = True
         st.rerun()
 
-    # Check if there's a message being processed
-    if (st.session_state.processing and
-            st.session_state.conversation_history and
-            st.session_state.conversation_history[-1]["assistant"] is None):
-
-        last_message = st.session_state.conversation_history[-1]
-        try:
-            result = run_async_task(process_user_message_async(
-                last_message["user"],
-                st.session_state.conversation_history[:-1]  # Exclude the current message being processed
-            ))
-
-            # Update the message with the response
-            st.session_state.conversation_history[-1]["assistant"] = result["response"]
-            st.session_state.processing = False
-            st.rerun()
-
-        except Exception as e:
-            error_msg = f"Error processing message: {str(e)}"
-            st.session_state.conversation_history[-1]["assistant"] = error_msg
-            st.session_state.processing = False
-            logger.error(f"Error in main processing: {e}\n{traceback.format_exc()}")
-            st.rerun()
-
-    # Display processing status
-    if st.session_state.processing:
-        st.info("Processing your message...")
-
-    # Clear conversation button
-    if st.session_state.conversation_history:
-        if st.button("Clear Conversation"):
-            st.session_state.conversation_history = []
-            st.session_state.input_key += 1
-            st.rerun()
-
     # Footer
     st.markdown("---")
     st.markdown("""
@@ -1,22 +1,33 @@
 import asyncio
+import hashlib
 import os
 import traceback
 import sys
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import islice
 
 # Fix for Windows asyncio subprocess issue - MUST be at the top
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
+import httpx
 from dotenv import load_dotenv
 from agno.agent import Agent
-from agno.models.openai import OpenAIChat
 from agno.tools.mcp import MCPTools
-from typing import List, Dict, Any
+from typing import AsyncIterator, Deque, Iterable, List, Dict, Any, Optional, Tuple, Union
 from mcp import ClientSession, StdioServerParameters
 from textwrap import dedent
 from mcp.client.stdio import stdio_client
+from pydantic import BaseModel
 from agno.utils.log import logger
-import signal
+from memory import SQLiteMemory
+from openai_model import make_openai
+from specialties import lookup_specialties
+
+logger.info(f"Platform: {sys.platform}, Event loop policy: {type(asyncio.get_event_loop_policy()).__name__}")
 
 # Instructions for the Symptom Analysis Agent
 SYMPTOM_ANALYZER_INSTRUCTIONS = dedent(
@@ -26,27 +37,34 @@ SYMPTOM_ANALYZER_INSTRUCTIONS = dedent(
     For each user message:
     1. Analyze any symptoms or conditions provided
     2. Identify relevant medical specialties
-    3. Return a comma-separated list of specialty names
-    4. If no symptoms are provided, ask for clarification or more details
+    3. Return the specialty names in `specialties`
+    4. If no symptoms are provided, put a clarifying question in `clarification` instead
     5. Use the conversation history to refine your analysis if needed
 
     Example:
     - User: "I have chest pain and shortness of breath"
-      Response: "Cardiologist, Cardiology, Heart Specialist"
+      Response: {"specialties": ["Cardiologist", "Cardiology", "Heart Specialist"], "clarification": null}
     - User: "What about headaches?"
-      Response: "Neurologist, Neurology, Brain Specialist"
+      Response: {"specialties": ["Neurologist", "Neurology", "Brain Specialist"], "clarification": null}
     - User: "I'm not sure what's wrong"
-      Response: "Could you describe any symptoms you're experiencing?"
+      Response: {"specialties": [], "clarification": "Could you describe any symptoms you're experiencing?"}
 
     IMPORTANT RULES:
-    - Return ONLY a comma-separated list of specialties if symptoms are clear
-    - If clarification is needed, return a question as plain text
+    - Fill `specialties` only if symptoms are clear
+    - If clarification is needed, leave `specialties` empty and ask in `clarification`
     - Use standard medical specialty names
     - Include common variations (e.g., "Cardiologist, Cardiology")
     - Do not provide explanations unless asked
     """
 )
 
+
+class SymptomResult(BaseModel):
+    """Structured reply of the symptom analyzer (no defaults: OpenAI strict schemas reject them)"""
+    specialties: List[str]
+    clarification: Optional[str]
+
+
 # Instructions for the Database Query Agent
 DATABASE_QUERY_INSTRUCTIONS = dedent(
     """\
@@ -78,6 +96,19 @@ DATABASE_QUERY_INSTRUCTIONS = dedent(
     """
 )
 
+# Per-message prompts, unindented so no whitespace tokens are sent to the model
+_SYMPTOM_PROMPT_TPL = (
+    "Conversation history:\n{history}\n\n"
+    "Current message: \"{msg}\"\n\n"
+    "Analyze the symptoms and return the specialties, or a question if clarification is needed."
+)
+_DB_PROMPT_TPL = (
+    "Conversation history:\n{history}\n\n"
+    "Current message: \"{msg}\"\n\n"
+    "Search for consultants with these specialties: {specialties}\n"
+    "Use flexible matching for any of: {specialties}"
+)
+
 load_dotenv()
 MODEL_ID = os.getenv('MODEL_ID')
 MODEL_API_KEY = os.getenv('MODEL_API_KEY')
@@ -85,38 +116,34 @@ MODEL_API_KEY = os.getenv('MODEL_API_KEY')
 if not MODEL_ID or not MODEL_API_KEY:
     raise ValueError('MODEL_ID and MODEL_API_KEY must be set')
 
+# Conversation context sent to the model: the most recent turns, within a character budget
+MAX_HISTORY_TURNS = int(os.getenv('HISTORY_WINDOW', '8'))
+MAX_HISTORY_CHARS = 4000
 
-class DatabaseAgent:
-    """Manage database agent lifecycle and cleanup"""
+# Per-user chat memory, persisted so history survives restarts and isn't held in RAM
+CHAT_MEMORY_PATH = os.getenv(
+    'CHAT_MEMORY_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.chat_memory.sqlite3')
+)
+# Stored messages are deleted after this many days
+CHAT_MEMORY_MAX_AGE_DAYS = float(os.getenv('CHAT_MEMORY_MAX_AGE_DAYS', '30'))
 
-    def __init__(self):
-        self.session = None
-        self.agent = None
+# Shared HTTP client so every OpenAI request reuses one connection pool
+# (agno otherwise builds a new client, and a new TLS connection, per request)
+HTTP_CLIENT = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
 
-    async def cleanup(self):
-        """Cleanup resources"""
-        try:
-            if self.session and hasattr(self.session, 'close'):
-                await self.session.close()
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.warning(f"Cleanup warning: {e}")
+
+# One model for every agent: agno passes tools and response format per call, so it holds no run state.
+# Agents are cheap and built per run, since they keep run state and memory on the instance.
+_MODEL = make_openai(MODEL_ID, MODEL_API_KEY, http_client=HTTP_CLIENT)
 
 
 def create_symptom_analyzer() -> Agent:
-    """Create symptom analysis agent"""
+    """Create symptom analysis agent for one run"""
     try:
-        try:
-            openai_model = OpenAIChat(model=MODEL_ID, api_key=MODEL_API_KEY)
-        except TypeError:
-            try:
-                openai_model = OpenAIChat(model_name=MODEL_ID, api_key=MODEL_API_KEY)
-            except TypeError:
-                openai_model = OpenAIChat(MODEL_ID, api_key=MODEL_API_KEY)
-
         return Agent(
-            model=openai_model,
-            instructions=SYMPTOM_ANALYZER_INSTRUCTIONS,
+            model=_MODEL,
+            system_message=SYMPTOM_ANALYZER_INSTRUCTIONS,
+            response_model=SymptomResult,
             markdown=False,
             show_tool_calls=False,
         )
@@ -125,24 +152,20 @@ def create_symptom_analyzer() -> Agent:
         raise
 
 
-async def create_database_agent(session: ClientSession) -> Agent:
-    """Create database query agent"""
-    try:
-        mcp_tool = MCPTools(session=session)
-        await mcp_tool.initialize()
+async def create_mcp_tools(session: ClientSession) -> MCPTools:
+    """Create the MCP toolkit for a session, listing the server's tools once"""
+    mcp_tool = MCPTools(session=session)
+    await mcp_tool.initialize()
+    return mcp_tool
 
-        try:
-            openai_model = OpenAIChat(model=MODEL_ID, api_key=MODEL_API_KEY)
-        except TypeError:
-            try:
-                openai_model = OpenAIChat(model_name=MODEL_ID, api_key=MODEL_API_KEY)
-            except TypeError:
-                openai_model = OpenAIChat(MODEL_ID, api_key=MODEL_API_KEY)
 
+def create_database_agent(mcp_tool: MCPTools) -> Agent:
+    """Create database query agent for one run"""
+    try:
         return Agent(
-            model=openai_model,
+            model=_MODEL,
             tools=[mcp_tool],
-            instructions=DATABASE_QUERY_INSTRUCTIONS,
+            system_message=DATABASE_QUERY_INSTRUCTIONS,
             markdown=False,
             show_tool_calls=True,
         )
@@ -151,87 +174,377 @@ async def create_database_agent(session: ClientSession) -> Agent:
         raise
 
 
-async def process_chat_message(user_message: str, conversation_history: List[Dict[str, Any]]) -> Dict[str, str]:
+@dataclass(frozen=True, slots=True)
+class DbConfig:
+    """Database connection settings, read from the environment once at import"""
+    host: str
+    user: str
+    password: str
+    name: str
+
+
+# Settings can't change while the process runs, so check them once here
+_REQUIRED_ENV = ("DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME")
+_missing_env = [var for var in _REQUIRED_ENV if not os.getenv(var)]
+if _missing_env:
+    raise RuntimeError(f"Missing environment variables: {', '.join(_missing_env)}")
+
+DB_CONFIG = DbConfig(
+    host=os.environ["DB_HOST"],
+    user=os.environ["DB_USER"],
+    password=os.environ["DB_PASSWORD"],
+    name=os.environ["DB_NAME"],
+)
+
+# Parameters used to launch the MCP SQL server, built once
+SERVER_PARAMS = StdioServerParameters(
+    command='uvx',
+    args=[
+        'mcp-sql-server',
+        "--db-host", DB_CONFIG.host,
+        "--db-user", DB_CONFIG.user,
+        "--db-password", DB_CONFIG.password,
+        "--db-database", DB_CONFIG.name,
+    ],
+)
+
+
+# Upper bound on waiting for the MCP server to shut down (instead of fixed cleanup sleeps)
+MCP_CLOSE_TIMEOUT = 2.0
+# How long a caller waits for the MCP server to start (initialize and list its tools)
+MCP_START_TIMEOUT = 15.0
+# How long the MCP server gets to answer the health probe after a failed query
+MCP_PING_TIMEOUT = 0.5
+
+
+class MCPSessionPool:
     """
-    Process a single chat message, maintaining conversation context.
-    Returns a dictionary with response and status.
+    Open one MCP stdio session lazily and reuse it, with its toolkit, across messages.
+    The session is owned by a background task because anyio requires the stdio client
+    to be entered and exited from the same task.
     """
-    logger.info(f"Platform: {sys.platform}, Event loop policy: {type(asyncio.get_event_loop_policy()).__name__}")
 
-    required_variables = ["DB_HOST", "DB_USER", "DB_PASSWORD", "DB_NAME"]
-    missing_variables = [var for var in required_variables if not os.getenv(var)]
-    if missing_variables:
-        return {"response": f"Error: Missing environment variables: {', '.join(missing_variables)}", "status": "error"}
+    def __init__(self):
+        self._session = None
+        self._tools = None
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._ready = None
+        self._closing = None
+
+    async def _hold_session(self, ready: asyncio.Future):
+        """Open the session, then keep it open until close() is called"""
+        try:
+            async with AsyncExitStack() as stack:
+                # Arguments include the DB password, so only the command is logged
+                logger.debug("Starting MCP server: %s %s", SERVER_PARAMS.command, SERVER_PARAMS.args[0])
+
+                read, write = await stack.enter_async_context(stdio_client(SERVER_PARAMS))
+                session = await stack.enter_async_context(ClientSession(read, write))
+                await session.initialize()
+                self._tools = await create_mcp_tools(session)
+                self._session = session
+                if not ready.done():
+                    ready.set_result(None)
+                await self._closing.wait()
+        except Exception as e:
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning(f"MCP session ended unexpectedly: {e}")
+        finally:
+            # Cancelled before it was ready: fail the callers waiting on startup instead of leaving them hanging
+            if not ready.done():
+                ready.set_exception(RuntimeError("MCP session closed before it was ready"))
+            self._session = None
+            self._tools = None
+
+    async def _ensure_open(self):
+        """Start the session if it is not running and wait until it is ready"""
+        async with self._lock:
+            if self._task is None or self._task.done():
+                self._closing = asyncio.Event()
+                self._ready = asyncio.get_running_loop().create_future()
+                self._task = asyncio.create_task(self._hold_session(self._ready))
+            ready = self._ready
+            task = self._task
+        # Startup already lists the server's tools, so a server that answers in time is healthy.
+        # Shielded so a caller that gives up doesn't cancel the startup other callers share.
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), MCP_START_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            # A hung startup is dropped so the next message starts a new server
+            task.cancel()
+            raise RuntimeError(f"MCP server did not start within {MCP_START_TIMEOUT}s") from e
+
+    async def get_session(self) -> ClientSession:
+        """Return the shared MCP session, opening it on first use"""
+        await self._ensure_open()
+        return self._session
+
+    async def get_agent(self) -> Agent:
+        """Return a new database agent using the shared session's toolkit"""
+        await self._ensure_open()
+        return create_database_agent(self._tools)
+
+    async def check_health(self):
+        """Ping the MCP server; if it doesn't answer, close the session so the next message starts a new one"""
+        session = self._session
+        if session is None:
+            return
+        try:
+            await asyncio.wait_for(session.list_tools(), MCP_PING_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"MCP server did not respond to health check, restarting it: {e!r}")
+            await self.close()
+
+    async def close(self):
+        """Close the session and stop the MCP server process"""
+        if self._task is not None and not self._task.done():
+            self._closing.set()
+            try:
+                await asyncio.wait_for(self._task, MCP_CLOSE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # wait_for cancelled the owner task, which tears down the stdio client
+                logger.warning(f"MCP session did not close within {MCP_CLOSE_TIMEOUT}s, cancelled it")
+        self._task = None
 
-    # Step 1: Analyze symptoms
-    logger.info("Analyzing message for symptoms...")
-    symptom_analyzer = create_symptom_analyzer()
 
-    # Construct prompt with conversation history
-    history_prompt = "\n".join([f"User: {msg['user']}\nAssistant: {msg['assistant']}" for msg in conversation_history])
-    symptom_prompt = f"""
-    Conversation history:
-    {history_prompt}
+_POOL = MCPSessionPool()
 
-    Current message: "{user_message}"
 
-    Analyze the symptoms and return a comma-separated list of specialties or a question if clarification is needed.
+async def close_mcp_session():
+    """Close the shared MCP session; call on shutdown"""
+    await _POOL.close()
+
+
+async def check_mcp_health():
+    """Re-check the shared MCP server after a message failed or timed out"""
+    await _POOL.check_health()
+
+
+# One conversation turn: a (user, assistant) tuple, or a legacy {"user", "assistant"} dict
+HistoryTurn = Union[Tuple[str, str], Dict[str, Any]]
+_TURN_LABELS_LEN = len("User: \nAssistant: ")
+
+
+@dataclass(slots=True)
+class ChatSession:
     """
+    Conversation context kept as a single prompt string, joined once per session.
+    Only the last MAX_HISTORY_TURNS turns are kept, and older turns are dropped
+    while the history is longer than MAX_HISTORY_CHARS.
+    """
+    joined_history: str = ""
+    turns: Deque[Tuple[str, str]] = field(default_factory=lambda: deque(maxlen=MAX_HISTORY_TURNS))
+
+    def _trim_and_join(self):
+        """Drop the oldest turns past the character budget, then join the rest into the prompt string"""
+        # Length of the joined history: each turn plus its label text, newline-separated
+        length = sum(len(u) + len(a) + _TURN_LABELS_LEN for u, a in self.turns) + len(self.turns) - 1
+        while length > MAX_HISTORY_CHARS and len(self.turns) > 1:
+            u, a = self.turns.popleft()
+            length -= len(u) + len(a) + _TURN_LABELS_LEN + 1
+
+        self.joined_history = "\n".join(f"User: {u}\nAssistant: {a}" for u, a in self.turns)[-MAX_HISTORY_CHARS:]
+
+    def add_turn(self, user: str, assistant: str):
+        """Append a completed user/assistant exchange to the history"""
+        self.turns.append((user, assistant))
+        self._trim_and_join()
+
+    @classmethod
+    def from_history(cls, conversation_history: Iterable[HistoryTurn], turn_index: Optional[int] = None) -> "ChatSession":
+        """
+        Build a session from (user, assistant) tuples, or legacy {"user", "assistant"} dicts,
+        using only the first turn_index entries
+        """
+        session = cls()
+        # The deque keeps only the last MAX_HISTORY_TURNS; the prompt string is built once at the end
+        for turn in islice(conversation_history, turn_index):
+            if isinstance(turn, dict):
+                turn = (turn['user'], turn['assistant'])
+            session.turns.append(tuple(turn))
+        session._trim_and_join()
+        return session
+
+
+@lru_cache(maxsize=1)
+def get_memory() -> SQLiteMemory:
+    """Open the chat memory database on first use, keeping only what the history window can use"""
+    return SQLiteMemory(
+        CHAT_MEMORY_PATH,
+        keep_per_user=MAX_HISTORY_TURNS * 2,
+        max_age_seconds=CHAT_MEMORY_MAX_AGE_DAYS * 86400,
+    )
+
+
+def load_history(user_id: str) -> List[Tuple[str, str]]:
+    """Return a user's stored (user, assistant) turns, oldest first"""
+    turns = []
+    user = None
+    for role, content in get_memory().recent(user_id, MAX_HISTORY_TURNS * 2):
+        if role == "user":
+            user = content
+        elif user is not None:
+            turns.append((user, content))
+            user = None
+    return turns
+
+
+def save_turn(user_id: str, user: str, assistant: str):
+    """Store a completed turn in a user's chat memory"""
+    get_memory().add_turn(user_id, user, assistant)
+
+
+async def warmup_openai_connection():
+    """Open a pooled connection to the OpenAI API before the first message arrives"""
+    try:
+        await _MODEL.get_async_client().models.list()
+        logger.info("OpenAI connection pool warmed up")
+    except Exception as e:
+        logger.warning(f"OpenAI warmup failed: {e}")
+
+
+# Symptom analyses already done, keyed on (normalized message, hash of the history sent with it)
+SYMPTOM_CACHE_SIZE = 256
+_SYMPTOM_CACHE: "OrderedDict[Tuple[str, bytes], SymptomResult]" = OrderedDict()
+_SYMPTOM_INFLIGHT: Dict[Tuple[str, bytes], asyncio.Task] = {}
+
+
+async def _run_symptom_analyzer(user_message: str, history_prompt: str) -> SymptomResult:
+    """Ask the symptom analyzer for specialties, or a clarifying question"""
+    symptom_analyzer = create_symptom_analyzer()
 
+    symptom_prompt = _SYMPTOM_PROMPT_TPL.format(history=history_prompt, msg=user_message)
     specialty_response = await symptom_analyzer.arun(symptom_prompt)
-    response_content = specialty_response.content.strip()
-
-    # Check if clarification is needed
-    if not response_content or "?" in response_content:
-        return {"response": response_content or "Could you describe your symptoms?", "status": "clarification"}
-
-    specialties = response_content
-    logger.info(f"Identified specialties: {specialties}")
-
-    # Step 2: Query database
-    logger.info("Querying database for consultants...")
-    logger.info(f"Using DB credentials: host={os.getenv('DB_HOST')}, user={os.getenv('DB_USER')}")
-
-    server_parameters = StdioServerParameters(
-        command='uvx',
-        args=[
-            'mcp-sql-server',
-            "--db-host", os.getenv("DB_HOST"),
-            "--db-user", os.getenv("DB_USER"),
-            "--db-password", os.getenv("DB_PASSWORD"),
-            "--db-database", os.getenv("DB_NAME"),
-        ],
-    )
+    if isinstance(specialty_response.content, SymptomResult):
+        return specialty_response.content
+
+    # The reply didn't parse into the schema; show it to the user rather than search with it
+    logger.warning(f"Symptom analyzer returned unstructured output: {specialty_response.content!r}")
+    return SymptomResult(specialties=[], clarification=str(specialty_response.content or "").strip() or None)
 
-    logger.info(f"Server parameters: {server_parameters}")
-    db_agent = DatabaseAgent()
+
+async def _analyze_symptoms(user_message: str, history_prompt: str) -> SymptomResult:
+    """
+    Cached symptom analysis.
+    Concurrent identical requests share one analyzer call instead of each making their own.
+    """
+    key = (user_message.strip().lower(), hashlib.blake2b(history_prompt.encode(), digest_size=8).digest())
+    if key in _SYMPTOM_CACHE:
+        _SYMPTOM_CACHE.move_to_end(key)
+        return _SYMPTOM_CACHE[key]
+
+    task = _SYMPTOM_INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(_run_symptom_analyzer(user_message, history_prompt))
+        _SYMPTOM_INFLIGHT[key] = task
+
+        def finish(done: asyncio.Task):
+            _SYMPTOM_INFLIGHT.pop(key, None)
+            if not done.cancelled() and done.exception() is None:
+                _SYMPTOM_CACHE[key] = done.result()
+                if len(_SYMPTOM_CACHE) > SYMPTOM_CACHE_SIZE:
+                    _SYMPTOM_CACHE.popitem(last=False)
+
+        task.add_done_callback(finish)
+
+    # Shielded so one caller timing out doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+
+async def process_chat_message_stream(
+        user_message: str,
+        conversation_history: Union[ChatSession, Iterable[HistoryTurn], None] = None,
+        turn_index: Optional[int] = None,
+        user_id: Optional[str] = None
+) -> AsyncIterator[Dict[str, str]]:
+    """
+    Process a single chat message, maintaining conversation context.
+    With user_id, the context is loaded from and the turn saved to the chat memory;
+    otherwise conversation_history is a ChatSession, or a sequence (e.g. a deque) of
+    (user, assistant) tuples or legacy {"user", "assistant"} dicts, of which only the
+    first turn_index entries are used (all by default).
+    Yields the response in pieces as the database agent generates it; each piece
+    is a dictionary with response text and status.
+    """
+    # Start the MCP session (if it isn't already open) while the symptoms are analyzed
+    agent_task = asyncio.create_task(_POOL.get_agent())
 
     try:
-        async with stdio_client(server_parameters) as (read, write):
-            async with ClientSession(read, write) as session:
-                db_agent.session = session
-                await session.initialize()
-                database_agent = await create_database_agent(session)
+        if user_id is not None:
+            # SQLite calls run in a worker thread so they don't block other messages on this loop
+            conversation_history = ChatSession.from_history(await asyncio.to_thread(load_history, user_id))
+        elif not isinstance(conversation_history, ChatSession):
+            conversation_history = ChatSession.from_history(conversation_history or [], turn_index)
+        history_prompt = conversation_history.joined_history
+
+        # Step 1: Analyze symptoms, skipping the LLM for common ones
+        specialties = lookup_specialties(user_message)
+        if specialties is None:
+            logger.info("Analyzing message for symptoms...")
+            symptom_result = await _analyze_symptoms(user_message, history_prompt)
+
+            # Check if clarification is needed
+            if symptom_result.clarification or not symptom_result.specialties:
+                clarification = symptom_result.clarification or "Could you describe your symptoms?"
+                if user_id is not None:
+                    await asyncio.to_thread(save_turn, user_id, user_message, clarification)
+                yield {"response": clarification, "status": "clarification"}
+                return
+
+            specialties = ", ".join(symptom_result.specialties)
+        logger.info(f"Identified specialties: {specialties}")
+
+        # Step 2: Query database
+        logger.info("Querying database for consultants...")
 
-                db_prompt = f"""
-                Conversation history:
-                {history_prompt}
+        try:
+            database_agent = await agent_task
 
-                Current message: "{user_message}"
+            db_prompt = _DB_PROMPT_TPL.format(history=history_prompt, msg=user_message, specialties=specialties)
+            db_response_stream = await database_agent.arun(db_prompt, stream=True)
+            response_parts = []
+            async for chunk in db_response_stream:
+                content = getattr(chunk, "content", None)
+                if isinstance(content, str) and content:
+                    response_parts.append(content)
+                    yield {"response": content, "status": "success"}
 
-                Search for consultants with these specialties: {specialties}
-                Use flexible matching for any of: {specialties}
-                """
+            if user_id is not None:
+                await asyncio.to_thread(save_turn, user_id, user_message, "".join(response_parts).strip())
 
-                db_response = await database_agent.arun(db_prompt)
-                return {"response": db_response.content.strip(), "status": "success"}
+        except Exception as e:
+            logger.error(f"Database query error: {e}\n{traceback.format_exc()}")
+            await _POOL.check_health()
+            yield {"response": f"Error: Unable to fetch consultants: {str(e)}", "status": "error"}
 
-    except Exception as e:
-        logger.error(f"Database query error: {e}\n{traceback.format_exc()}")
-        return {"response": f"Error: Unable to fetch consultants: {str(e)}", "status": "error"}
     finally:
-        await db_agent.cleanup()
-        await asyncio.sleep(0.2)
+        # Stop waiting on the session if we never needed it; the pool keeps starting it
+        if not agent_task.done():
+            agent_task.cancel()
+        agent_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+
+async def process_chat_message(
+        user_message: str,
+        conversation_history: Union[ChatSession, Iterable[HistoryTurn], None] = None,
+        turn_index: Optional[int] = None,
+        user_id: Optional[str] = None
+) -> Dict[str, str]:
+    """
+    Process a single chat message, maintaining conversation context.
+    Returns a dictionary with response and status.
+    """
+    chunks = []
+    status = "success"
+    async for chunk in process_chat_message_stream(user_message, conversation_history, turn_index, user_id):
+        if chunk["status"] == "error":
+            chunks = []
+        chunks.append(chunk["response"])
+        status = chunk["status"]
+    return {"response": "".join(chunks).strip(), "status": status}
 
 
 def signal_handler(signum, frame):
@@ -245,18 +558,33 @@ async def main():
     logger.info(f"Starting main function. Platform: {sys.platform}")
     logger.info(f"Event loop policy: {type(asyncio.get_event_loop_policy()).__name__}")
 
-    conversation_history = []
     test_messages = [
         "I have chest pain and shortness of breath",
-        "What about headaches?",
         "I'm not sure what's wrong"
     ]
+    # Follow-up that only makes sense with the first message's turn as history
+    follow_up = "What about headaches?"
 
-    for msg in test_messages:
-        logger.info(f"Processing message: {msg}")
-        result = await process_chat_message(msg, conversation_history)
-        logger.info(f"Response: {result['response']}")
-        conversation_history.append({"user": msg, "assistant": result['response']})
+    # The first messages are independent probes, so run them concurrently over the shared session
+    semaphore = asyncio.Semaphore(4)
+
+    async def process(msg: str, history):
+        async with semaphore:
+            logger.info(f"Processing message: {msg}")
+            result = await process_chat_message(msg, history)
+            logger.info(f"Response: {result['response']}")
+            return result
+
+    try:
+        results = await asyncio.gather(*(process(msg, []) for msg in test_messages), return_exceptions=True)
+        for msg, result in zip(test_messages, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Message {msg!r} failed: {result!r}")
+
+        if not isinstance(results[0], BaseException):
+            await process(follow_up, [(test_messages[0], results[0]['response'])])
+    finally:
+        await close_mcp_session()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+# Expired messages are deleted at most this often, rather than on every write
+PRUNE_INTERVAL_SECONDS = 3600
+
+
+class SQLiteMemory:
+    """
+    Chat messages stored per user in SQLite, read back as the most recent K.
+    Only the newest keep_per_user messages of a user are kept, and messages older
+    than max_age_seconds are deleted for every user.
+    """
+
+    def __init__(self, path: str, keep_per_user: Optional[int] = None, max_age_seconds: Optional[float] = None):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.keep_per_user = keep_per_user
+        self.max_age_seconds = max_age_seconds
+        self._pruned_at = 0.0
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL lets readers keep going while a turn is being written
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.executescript(
+                "CREATE TABLE IF NOT EXISTS msgs(uid TEXT, ts INTEGER, role TEXT, content TEXT);"
+                "CREATE INDEX IF NOT EXISTS ix_msgs_uid_ts ON msgs(uid, ts DESC);"
+            )
+            self._prune_expired()
+
+    def _prune_expired(self):
+        """Delete messages past max_age_seconds; the caller holds the lock"""
+        if self.max_age_seconds is None:
+            return
+        if self._pruned_at and time.monotonic() - self._pruned_at < PRUNE_INTERVAL_SECONDS:
+            return
+        cutoff = time.time_ns() - int(self.max_age_seconds * 1e9)
+        self.db.execute("DELETE FROM msgs WHERE ts < ?", (cutoff,))
+        self.db.commit()
+        self._pruned_at = time.monotonic()
+
+    def add_turn(self, uid: str, user: str, assistant: str):
+        """Store a user message and the assistant's reply, dropping the user's oldest messages past the limit"""
+        ts = time.time_ns()
+        with self._lock:
+            self.db.executemany(
+                "INSERT INTO msgs(uid, ts, role, content) VALUES (?, ?, ?, ?)",
+                [(uid, ts, "user", user), (uid, ts + 1, "assistant", assistant)],
+            )
+            if self.keep_per_user is not None:
+                self.db.execute(
+                    "DELETE FROM msgs WHERE uid = ? AND ts < "
+                    "(SELECT ts FROM msgs WHERE uid = ? ORDER BY ts DESC LIMIT 1 OFFSET ?)",
+                    (uid, uid, self.keep_per_user - 1),
+                )
+            self.db.commit()
+            self._prune_expired()
+
+    def recent(self, uid: str, k: int) -> List[Tuple[str, str]]:
+        """Return the last k (role, content) messages for a user, oldest first"""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT role, content FROM msgs WHERE uid = ? ORDER BY ts DESC LIMIT ?",
+                (uid, k),
+            ).fetchall()
+        rows.reverse()
+        return rows
+
+    def clear(self, uid: str):
+        """Delete all stored messages for a user"""
+        with self._lock:
+            self.db.execute("DELETE FROM msgs WHERE uid = ?", (uid,))
+            self.db.commit()
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self.db.close()
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    def test_sqlite_memory():
+        """Check the per-user limit and the age-based pruning"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "memory.sqlite3")
+
+            memory = SQLiteMemory(path, keep_per_user=4, max_age_seconds=60)
+            for i in range(3):
+                memory.add_turn("alice", f"question {i}", f"answer {i}")
+            memory.add_turn("bob", "hello", "hi")
+            assert memory.recent("alice", 10) == [
+                ("user", "question 1"), ("assistant", "answer 1"),
+                ("user", "question 2"), ("assistant", "answer 2"),
+            ]
+            assert memory.recent("bob", 10) == [("user", "hello"), ("assistant", "hi")]
+
+            # A message older than max_age_seconds is deleted when the database is opened again
+            stale_ts = time.time_ns() - int(120 * 1e9)
+            memory.db.execute("INSERT INTO msgs(uid, ts, role, content) VALUES ('bob', ?, 'user', 'old')", (stale_ts,))
+            memory.db.commit()
+            memory.close()
+
+            memory = SQLiteMemory(path, keep_per_user=4, max_age_seconds=60)
+            assert memory.recent("bob", 10) == [("user", "hello"), ("assistant", "hi")]
+            memory.clear("alice")
+            assert memory.recent("alice", 10) == []
+            memory.close()
+        print("SQLiteMemory checks passed")
+
+
+    test_sqlite_memory()
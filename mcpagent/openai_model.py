@@ -0,0 +1,13 @@
+import inspect
+from agno.models.openai import OpenAIChat
+
+# agno versions differ on the parameter that takes the model id; check the signature once
+_OPENAI_PARAMS = inspect.signature(OpenAIChat).parameters
+_OPENAI_KW = next((kw for kw in ("model", "model_name") if kw in _OPENAI_PARAMS), None)
+
+
+def make_openai(model_id: str, api_key: str, **kwargs) -> OpenAIChat:
+    """Create an OpenAI model for the given id and key; other keyword arguments go to OpenAIChat"""
+    if _OPENAI_KW:
+        return OpenAIChat(**{_OPENAI_KW: model_id}, api_key=api_key, **kwargs)
+    return OpenAIChat(model_id, api_key=api_key, **kwargs)
@@ -0,0 +1,74 @@
+import re
+from typing import Optional
+
+# Common symptoms mapped to specialties, so they can be answered without an LLM call
+SYMPTOM_KEYWORDS = {
+    "chest pain": ["Cardiologist", "Cardiology", "Heart Specialist"],
+    "shortness of breath": ["Cardiologist", "Cardiology", "Heart Specialist"],
+    "palpitations": ["Cardiologist", "Cardiology", "Heart Specialist"],
+    "headache": ["Neurologist", "Neurology", "Brain Specialist"],
+    "migraine": ["Neurologist", "Neurology", "Brain Specialist"],
+    "dizziness": ["Neurologist", "Neurology", "Brain Specialist"],
+    "memory problems": ["Neurologist", "Neurology", "Brain Specialist"],
+    "stomach pain": ["Gastroenterologist", "Gastroenterology", "Digestive Specialist"],
+    "nausea": ["Gastroenterologist", "Gastroenterology", "Digestive Specialist"],
+    "diarrhea": ["Gastroenterologist", "Gastroenterology", "Digestive Specialist"],
+    "joint pain": ["Orthopedic Surgeon", "Orthopedics", "Orthopedist"],
+    "back pain": ["Orthopedic Surgeon", "Orthopedics", "Orthopedist"],
+    "fracture": ["Orthopedic Surgeon", "Orthopedics", "Orthopedist"],
+    "skin rash": ["Dermatologist", "Dermatology"],
+    "acne": ["Dermatologist", "Dermatology"],
+    "hair loss": ["Dermatologist", "Dermatology"],
+}
+# Specialty word stems a user may name directly (e.g. "Show me oncologists")
+SPECIALTY_VOCAB = {
+    "cardiolog": ["Cardiologist", "Cardiology"],
+    "neurolog": ["Neurologist", "Neurology"],
+    "dermatolog": ["Dermatologist", "Dermatology"],
+    "oncolog": ["Oncologist", "Oncology"],
+    "hematolog": ["Hematologist", "Hematology"],
+    "gastroenterolog": ["Gastroenterologist", "Gastroenterology"],
+    "orthoped": ["Orthopedic Surgeon", "Orthopedics", "Orthopedist"],
+    "endocrinolog": ["Endocrinologist", "Endocrinology"],
+    "nephrolog": ["Nephrologist", "Nephrology"],
+    "urolog": ["Urologist", "Urology"],
+    "pulmonolog": ["Pulmonologist", "Pulmonology"],
+    "rheumatolog": ["Rheumatologist", "Rheumatology"],
+    "gynecolog": ["Gynecologist", "Gynecology"],
+    "ophthalmolog": ["Ophthalmologist", "Ophthalmology"],
+    "psychiatr": ["Psychiatrist", "Psychiatry"],
+    "pediatric": ["Pediatrician", "Pediatrics"],
+}
+_SPECIALTY_VOCAB_RE = re.compile(r'\b(' + "|".join(SPECIALTY_VOCAB) + r')\w*', re.IGNORECASE)
+
+# Minimum number of matched keywords or named specialties before the LLM is skipped
+KEYWORD_MATCH_THRESHOLD = 1
+
+_WORD_RE = re.compile(r'[a-z]+')
+
+
+def _normalize_words(text: str) -> str:
+    """Lowercase, drop non-letters and strip plural 's' so 'Headaches' matches 'headache'"""
+    words = (w[:-1] if len(w) > 3 and w.endswith('s') else w for w in _WORD_RE.findall(text.lower()))
+    return " ".join(words)
+
+
+_KEYWORD_INDEX = {_normalize_words(keyword): specialties for keyword, specialties in SYMPTOM_KEYWORDS.items()}
+
+
+def lookup_specialties(user_query: str) -> Optional[str]:
+    """Match the query against named specialties and the keyword table; None means an LLM is needed"""
+    specialties = []
+    score = 0
+    for stem in _SPECIALTY_VOCAB_RE.findall(user_query):
+        score += 1
+        specialties.extend(s for s in SPECIALTY_VOCAB[stem.lower()] if s not in specialties)
+
+    query = f" {_normalize_words(user_query)} "
+    for keyword, keyword_specialties in _KEYWORD_INDEX.items():
+        if f" {keyword} " in query:
+            score += 1
+            specialties.extend(s for s in keyword_specialties if s not in specialties)
+    if score >= KEYWORD_MATCH_THRESHOLD:
+        return ", ".join(specialties)
+    return None
@@ -1,12 +1,30 @@
 import os
+import re
 from dotenv import load_dotenv
-from agno.agent import Agent, RunResponse
+from agno.agent import Agent
 from agno.models.openai import OpenAIChat
 from textwrap import dedent
 from agno.utils.log import logger
+from openai_model import make_openai
 
 load_dotenv()
 
+# The specialty list is a single short line: the model may generate at most MAX_SPECIALTIES_TOKENS,
+# and a longer line is cut back to its last complete specialty within MAX_SPECIALTIES_CHARS
+MAX_SPECIALTIES_TOKENS = 100
+MAX_SPECIALTIES_CHARS = 256
+# Reasoning models count their hidden reasoning tokens against the same cap, so they get this much more
+REASONING_TOKEN_ALLOWANCE = 4000
+_REASONING_MODEL_RE = re.compile(r'(?:.*/)?(?:o\d|gpt-5)', re.IGNORECASE)
+
+
+def _completion_token_cap(model_id: str) -> int:
+    """Token cap for the specialty reply, leaving reasoning models room to think before answering"""
+    if _REASONING_MODEL_RE.match(model_id):
+        return MAX_SPECIALTIES_TOKENS + REASONING_TOKEN_ALLOWANCE
+    return MAX_SPECIALTIES_TOKENS
+
+
 # Instructions for the Symptom Analysis Agent
 SYMPTOM_ANALYZER_INSTRUCTIONS = dedent(
     """\
@@ -43,6 +61,12 @@ SYMPTOM_ANALYZER_INSTRUCTIONS = dedent(
 class SymptomAnalyzer:
     """Symptom Analysis Agent for identifying medical specialties"""
 
+    __slots__ = ("model_id", "model_api_key", "model")
+
+    # Models shared by every instance, keyed on (model_id, model_api_key).
+    # Agents are built per analysis, since they keep run state and memory on the instance.
+    _shared_models = {}
+
     def __init__(self):
         self.model_id = os.getenv('MODEL_ID')
         self.model_api_key = os.getenv('MODEL_API_KEY')
@@ -50,23 +74,24 @@ class SymptomAnalyzer:
         if not self.model_id or not self.model_api_key:
             raise ValueError('MODEL_ID and MODEL_API_KEY must be set in environment variables')
 
-        self.agent = self._create_agent()
+        self.model = self._get_model()
+
+    def _get_model(self) -> OpenAIChat:
+        """Return the OpenAI model for this id and key, reusing one already built"""
+        key = (self.model_id, self.model_api_key)
+        model = self._shared_models.get(key)
+        if model is None:
+            model = self._shared_models[key] = make_openai(
+                self.model_id, self.model_api_key, max_completion_tokens=_completion_token_cap(self.model_id)
+            )
+        return model
 
     def _create_agent(self) -> Agent:
-        """Create the symptom analysis agent"""
+        """Build a symptom analysis agent for one analysis"""
         try:
-            # Try different parameter names for OpenAIChat
-            try:
-                openai_model = OpenAIChat(model=self.model_id, api_key=self.model_api_key)
-            except TypeError:
-                try:
-                    openai_model = OpenAIChat(model_name=self.model_id, api_key=self.model_api_key)
-                except TypeError:
-                    openai_model = OpenAIChat(self.model_id, api_key=self.model_api_key)
-
             return Agent(
-                model=openai_model,
-                instructions=SYMPTOM_ANALYZER_INSTRUCTIONS,
+                model=self.model,
+                system_message=SYMPTOM_ANALYZER_INSTRUCTIONS,
                 markdown=False,
                 show_tool_calls=False,
             )
@@ -96,8 +121,13 @@ class SymptomAnalyzer:
             Return only the specialty names, comma-separated.
             """
 
-            response = await self.agent.arun(symptom_analysis_prompt)
-            specialties = response.content.strip()
+            # The token cap keeps the reply short, so there is nothing to gain from streaming it
+            response = await self._create_agent().arun(symptom_analysis_prompt)
+            specialties = str(response.content or "").strip().partition("\n")[0].rstrip()
+
+            if len(specialties) > MAX_SPECIALTIES_CHARS:
+                # Cut at the last comma so no specialty name is left half-written
+                specialties = specialties[:MAX_SPECIALTIES_CHARS].rpartition(",")[0] or specialties[:MAX_SPECIALTIES_CHARS]
 
             logger.info(f"Identified specialties: {specialties}")
             return specialties
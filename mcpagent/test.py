@@ -1,13 +1,44 @@
 import asyncio
-from database_agent import process_chat_message  # Import from agent.py (assuming database_agent is agent.py)
+import os
+import sys
+
+# Make the sibling modules importable however this file is run (python test.py, python -m mcpagent.test)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from database_agent import close_mcp_session, process_chat_message
+
+# Maximum number of messages in flight at once
+CONCURRENCY = 4
 
 async def call_function(message, conversation_history):
     result = await process_chat_message(message, conversation_history)
     print(result)
     return result
 
+async def call_batch(messages):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def call_one(message):
+        async with semaphore:
+            return await call_function(message, [])  # Empty history: each message is independent
+
+    try:
+        results = await asyncio.gather(*(call_one(message) for message in messages), return_exceptions=True)
+        for message, result in zip(messages, results):
+            if isinstance(result, BaseException):
+                print(f"Message {message!r} failed: {result!r}")
+        return results
+    finally:
+        await close_mcp_session()
+
 if __name__ == "__main__":
-    message = "get a list of all consultants who treat unexplained weight loss, fatigue, lumps or thickening"
-    conversation_history = []  # Empty history for initial message
-    # Run the async function using asyncio
-    result = asyncio.run(call_function(message, conversation_history))
\ No newline at end of file
+    messages = [
+        "get a list of all consultants who treat unexplained weight loss, fatigue, lumps or thickening",
+    ]
+    # One explicit loop, created under the event loop policy database_agent sets on import
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        results = loop.run_until_complete(call_batch(messages))
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
\ No newline at end of file